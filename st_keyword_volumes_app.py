@@ -1,11 +1,19 @@
+import asyncio
+import gzip
+import logging
+import aiohttp
+import orjson
+from aiohttp_client_cache import CachedResponse, CachedSession, SQLiteBackend
 import streamlit as st
 import pandas as pd
-import requests
+import numpy as np
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from io import StringIO
+from io import BytesIO
 from country_codes import country_code_dict  # Import country codes
 
+logger = logging.getLogger(__name__)
+
 
 # Load secrets
 SEMRUSH_API_KEY = st.secrets["SEMRUSH_API_KEY"]  # Use Streamlit secrets management
@@ -15,6 +23,48 @@ SEMRUSH_API_URL = 'https://api.semrush.com'
 AHREFS_OVERVIEW_API_URL = "https://api.ahrefs.com/v3/keywords-explorer/overview"
 AHREFS_HISTORY_API_URL = "https://api.ahrefs.com/v3/keywords-explorer/volume-history"
 
+# Concurrency limits for the API fan-out
+MAX_CONNECTIONS = 32
+MAX_CONNECTIONS_PER_API = 16  # Per host, so SEMrush and Ahrefs are capped independently
+CONNECT_TIMEOUT = 3  # Seconds
+READ_TIMEOUT = 10  # Seconds
+
+# Retries for connection errors and transient HTTP statuses, with exponential backoff
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.2  # Seconds, doubled after each attempt
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Parse SEMrush metrics straight into (nullable) numeric dtypes
+SEMRUSH_COLUMN_DTYPES = {
+    'Keyword': str,
+    'Search Volume': 'Int64',
+    'CPC': 'Float64',
+    'Competition': 'Float64',
+    'Number of Results': 'Int64',
+    'Trends': str,
+}
+
+# Keywords per SEMrush phrase_these / Ahrefs overview request (both APIs accept up to 100)
+API_BATCH_SIZE = 100
+
+# Persistent API response cache, keyed on URL and query params (keyword, country, dates)
+API_CACHE_NAME = 'kw_cache'
+API_CACHE_EXPIRE_AFTER = 86400  # Seconds
+# Credentials are stripped from the stored request URL and headers before a response is written
+API_CACHE_REDACTED_PARAMS = ('key',)
+API_CACHE_REDACTED_HEADERS = ('authorization',)  # Lowercase, matched case-insensitively
+
+# SEMrush reports errors as 200 responses with an "ERROR nn :: ..." body; ERROR 50 only means no keyword matched
+SEMRUSH_ERROR_PREFIX = b'ERROR '
+SEMRUSH_NOTHING_FOUND_PREFIX = b'ERROR 50 ::'
+
+# How long an assembled output table is reused for repeat submits with the same inputs
+PIPELINE_CACHE_TTL = 1800  # Seconds
+
+# Larger CSV downloads are gzipped; level 1 is the fastest and still compresses repetitive numbers well
+GZIP_CSV_ROW_THRESHOLD = 500
+GZIP_COMPRESS_LEVEL = 1
+
 
 # Set page configuration
 st.set_page_config(page_title="Keyword Data Fetcher")
@@ -30,77 +80,159 @@ priority_countries = [
     ("NL", "Netherlands")
 ]
 
-# Sort the rest of the countries alphabetically by name
-sorted_countries = sorted([(code, name) for code, name in country_code_dict.items() if (code, name) not in priority_countries], key=lambda x: x[1])
+@st.cache_resource
+def build_country_options():
+    """Build the ordered country names and the name-to-code lookup once per server process."""
+    # Sort the rest of the countries alphabetically by name
+    sorted_countries = sorted([(code, name) for code, name in country_code_dict.items() if (code, name) not in priority_countries], key=lambda x: x[1])
+
+    # Combine prioritized and sorted country lists
+    country_list = priority_countries + sorted_countries
+    country_names = [name for _, name in country_list]
+    country_name_to_code = {name: code for code, name in country_list}
+    return country_names, country_name_to_code
 
-# Combine prioritized and sorted country lists
-country_list = priority_countries + sorted_countries
+# Streamlit reruns the whole script on every interaction, so the country options are cached across reruns
+country_names, country_name_to_code = build_country_options()
 
 # Functions
-def fetch_semrush_data(keyword, database, display_date=None):
-    """Fetch keyword volume data from SEMrush."""
+class ApiRequestError(Exception):
+    """Raised when an API request returns an error status after retries."""
+
+class IncompleteTableError(Exception):
+    """Raised with the assembled table when some API requests failed, so the table is shown but not cached."""
+
+    def __init__(self, table):
+        super().__init__('Some API requests failed')
+        self.table = table
+
+class RedactedSQLiteBackend(SQLiteBackend):
+    """SQLite response cache that keeps the API credentials out of the stored requests."""
+
+    async def save_response(self, response, cache_key=None, expires=None):
+        cache_key = cache_key or self.create_key(response.method, response.url)
+        cached_response = await CachedResponse.from_client_response(response, expires)
+        cached_response.url = redact_url(cached_response.url)
+        cached_response.real_url = redact_url(cached_response.real_url)
+        cached_response.request_raw_headers = tuple(
+            (name, value) for name, value in cached_response.request_raw_headers
+            if name.decode('utf-8').lower() not in API_CACHE_REDACTED_HEADERS
+        )
+        await self.responses.write(cache_key, cached_response)
+
+def redact_url(url):
+    """Drop the credential query params from a URL."""
+    return url.with_query([(name, value) for name, value in url.query.items() if name not in API_CACHE_REDACTED_PARAMS])
+
+def is_semrush_error(body):
+    """Check whether a SEMrush response body is an error other than "nothing found"."""
+    return body.startswith(SEMRUSH_ERROR_PREFIX) and not body.startswith(SEMRUSH_NOTHING_FOUND_PREFIX)
+
+async def is_cacheable_response(response):
+    """Keep SEMrush error bodies, which arrive as 200 responses, out of the response cache."""
+    return not is_semrush_error(await response.read())
+
+def normalize_keyword(keyword):
+    """Normalize a keyword for matching batched API results back to the input, ignoring case and spacing."""
+    return ' '.join(keyword.casefold().split())
+
+async def fetch_response(session, url, **kwargs):
+    """GET a URL over the shared session, retrying transient failures, and return the status and body."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url, **kwargs) as response:
+                if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    return response.status, await response.read()
+        except aiohttp.ClientConnectionError:
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+
+async def fetch_semrush_data(session, keywords, database, display_date=None):
+    """Fetch keyword volume data from SEMrush for a batch of keywords."""
     semrush_database = database.lower()
     params = {
-        'type': 'phrase_this',
+        'type': 'phrase_these',
         'key': SEMRUSH_API_KEY,
-        'phrase': keyword,
+        'phrase': ';'.join(keywords),
         'export_columns': 'Ph,Nq,Cp,Co,Nr,Td',
         'database': semrush_database,
     }
     if display_date:
         params['display_date'] = display_date
-    response = requests.get(SEMRUSH_API_URL, params=params)
-    if response.status_code == 200:
-        lines = response.text.strip().split('\n')
-        headers = lines[0].strip().split(';')
-        headers = [header.strip() for header in headers]
-        data = [dict(zip(headers, line.strip().split(';'))) for line in lines[1:]]
-        return pd.DataFrame(data)
+    status, body = await fetch_response(session, SEMRUSH_API_URL, params=params)
+    # Errors such as an empty units balance still come back as 200, only "nothing found" is a real empty result
+    if status == 200 and not is_semrush_error(body):
+        return pd.read_csv(BytesIO(body), sep=';', encoding='utf-8', dtype=SEMRUSH_COLUMN_DTYPES, engine='c')
+    else:
+        raise ApiRequestError(f"API request failed with status {status} and message: {body.decode(errors='replace')}")
+
+def vectorized_monthly_volumes(df, month_year_columns):
+    """Calculate monthly search volumes from Trends data for all rows at once."""
+    trends = np.array([t.split(',') for t in df['Trends']], dtype=np.float64)
+    search_volume = df['Search Volume'].to_numpy(dtype=np.float64, na_value=np.nan)[:, None]
+    monthly_volumes = trends / trends.sum(axis=1, keepdims=True) * search_volume
+    return pd.DataFrame(monthly_volumes, index=df.index, columns=month_year_columns)
+
+def build_ahrefs_frame(keywords, overviews, histories, months):
+    """Build the Ahrefs output rows for all keywords column by column.
+
+    Keywords missing from histories (their request failed) get missing month values instead of zeros.
+    """
+    overview_rows = [overviews.get(normalize_keyword(keyword), {}) for keyword in keywords]
+    # Explicit nullable dtypes keep the metrics numeric next to missing values, even when a column is all null
+    df = pd.DataFrame({
+        'Keyword': keywords,
+        'Search Volume': pd.array([overview.get('volume') for overview in overview_rows], dtype='Int64'),
+        'CPC': pd.array([overview.get('cpc') for overview in overview_rows], dtype='Float64'),
+        'Global Volume': pd.array([overview.get('global_volume') for overview in overview_rows], dtype='Int64'),
+        'Parent Volume': pd.array([overview.get('parent_volume') for overview in overview_rows], dtype='Int64'),
+    })
+
+    # Pivot every keyword's history into one block of month columns in a single step;
+    # a month reported twice keeps its last value, months outside the output months are
+    # dropped and keywords without history get zeros
+    fetched_keywords = [keyword for keyword in keywords if keyword in histories]
+    histories = {keyword: history for keyword, history in histories.items() if not history.empty}
+    if histories:
+        monthly = (
+            pd.concat(histories, names=['Keyword'])
+            .reset_index(level='Keyword')
+            .drop_duplicates(['Keyword', 'Month'], keep='last')
+            .pivot(index='Keyword', columns='Month', values='Volume')
+            .reindex(columns=months)
+            .reindex(fetched_keywords, fill_value=0)
+            .reindex(keywords)
+            .convert_dtypes()
+        )
     else:
-        st.error(f"API request failed with status {response.status_code} and message: {response.text}")
-        return pd.DataFrame()
-
-def calculate_monthly_volumes(row, end_date):
-    """Calculate monthly search volumes from Trends data."""
-    trends = list(map(float, row['Trends'].split(',')))
-    search_volume = int(row['Search Volume'])
-    trends_sum = sum(trends)
-    monthly_volumes = [(trend / trends_sum) * search_volume for trend in trends]
-
-    # Generate monthly columns in chronological order
-    month_year_columns = []
-    current_date = end_date - relativedelta(months=11)
-    for i in range(12):
-        month_year_columns.append(f"{current_date:%b-%Y}")
-        current_date += relativedelta(months=1)
-
-    return pd.Series(monthly_volumes, index=month_year_columns)
-
-def fetch_ahrefs_overview_data(keyword, country):
-    """Fetch keyword overview data from Ahrefs."""
+        monthly = pd.DataFrame(0, index=fetched_keywords, columns=months).reindex(keywords).convert_dtypes()
+    monthly.columns = months.strftime('%b-%Y')
+    df = pd.concat([df, monthly.reset_index(drop=True)], axis=1)
+    df['Datasource'] = 'Ahrefs'
+    return df
+
+async def fetch_ahrefs_overview_data(session, keywords, country):
+    """Fetch keyword overview data from Ahrefs for a batch of keywords, keyed by normalized keyword."""
     headers = {
         'Authorization': 'Bearer ' + AHREFS_API_KEY,
         'Accept': 'application/json'
     }
     params = {
-        'keywords': keyword,
+        'keywords': ','.join(keywords),
         'country': country.lower(),
         'output': 'json',
-        'select': 'volume,cpc,global_volume,parent_volume'
+        'select': 'keyword,volume,cpc,global_volume,parent_volume'
     }
-    response = requests.get(AHREFS_OVERVIEW_API_URL, headers=headers, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        print(data)
-        if 'keywords' in data:
-            return data['keywords'][0]
-        else:
-            return {}
+    status, body = await fetch_response(session, AHREFS_OVERVIEW_API_URL, headers=headers, params=params)
+    if status == 200:
+        data = orjson.loads(body)
+        logger.debug("Ahrefs overview response: %s", data)
+        return {normalize_keyword(overview['keyword']): overview for overview in data.get('keywords', [])}
     else:
-        st.error(f"API request failed with status {response.status_code} and message: {response.text}")
-        return {}
+        raise ApiRequestError(f"API request failed with status {status} and message: {body.decode(errors='replace')}")
 
-def fetch_ahrefs_history_data(keyword, country, start_date, end_date, fetch_last_12_months=False):
+async def fetch_ahrefs_history_data(session, keyword, country, start_date, end_date, fetch_last_12_months=False):
     """Fetch historical keyword volume data from Ahrefs."""
     headers = {
         'Authorization': 'Bearer ' + AHREFS_API_KEY,
@@ -118,29 +250,166 @@ def fetch_ahrefs_history_data(keyword, country, start_date, end_date, fetch_last
         'end_date': end_date.strftime('%Y-%m-%d')
     }
     
-    response = requests.get(AHREFS_HISTORY_API_URL, headers=headers, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        print(data)
-        monthly_data = []
-        for metric in data['metrics']:
-            date_str = datetime.strptime(metric['date'], '%Y-%m-%dT%H:%M:%SZ').strftime('%b-%Y')
-            monthly_data.append({'Month-Year': date_str, 'Volume': metric['volume']})
-        return pd.DataFrame(monthly_data)
+    status, body = await fetch_response(session, AHREFS_HISTORY_API_URL, headers=headers, params=params)
+    if status == 200:
+        data = orjson.loads(body)
+        logger.debug("Ahrefs history response: %s", data)
+        metrics = data['metrics']
+        dates = pd.to_datetime([metric['date'] for metric in metrics], format='%Y-%m-%dT%H:%M:%SZ', cache=True)
+        return pd.DataFrame({'Month': dates.to_period('M'), 'Volume': [metric['volume'] for metric in metrics]})
+    else:
+        raise ApiRequestError(f"API request failed with status {status} and message: {body.decode(errors='replace')}")
+
+def without_failures(results, empty_result):
+    """Report fetches that raised an error and replace them with an empty result."""
+    for result in results:
+        if isinstance(result, ApiRequestError):
+            st.error(str(result))
+        elif isinstance(result, Exception):
+            st.error(f"API request failed: {result!r}")
+    return [empty_result if isinstance(result, Exception) else result for result in results]
+
+async def fetch_all_keyword_data(keywords, datasources, semrush_database, country, start_date, end_date):
+    """Fetch data for all keywords in batches, overlapping the API calls over a shared connection pool.
+
+    Returns the SEMrush frame, Ahrefs overviews keyed by normalized keyword, Ahrefs history frames keyed by keyword
+    and whether every request succeeded.
+    """
+    batches = [keywords[i:i + API_BATCH_SIZE] for i in range(0, len(keywords), API_BATCH_SIZE)]
+    semrush_fetches, overview_fetches, history_fetches = [], [], []
+
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_API)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    cache = RedactedSQLiteBackend(API_CACHE_NAME, expire_after=API_CACHE_EXPIRE_AFTER, filter_fn=is_cacheable_response)
+    async with CachedSession(cache=cache, connector=connector, timeout=timeout) as session:
+        if 'semrush' in datasources:
+            semrush_fetches = [fetch_semrush_data(session, batch, database=semrush_database, display_date=end_date.strftime("%Y%m15")) for batch in batches]
+        if 'ahrefs' in datasources:
+            # Align Ahrefs history with the 12 months of SEMrush trends when both are selected
+            fetch_last_12_months = 'semrush' in datasources
+            overview_fetches = [fetch_ahrefs_overview_data(session, batch, country) for batch in batches]
+            history_fetches = [fetch_ahrefs_history_data(session, keyword, country, start_date, end_date, fetch_last_12_months=fetch_last_12_months) for keyword in keywords]
+        # A request that still fails after retries only loses its own keywords, not the whole submit
+        semrush_dfs, overviews, histories = await asyncio.gather(
+            asyncio.gather(*semrush_fetches, return_exceptions=True),
+            asyncio.gather(*overview_fetches, return_exceptions=True),
+            asyncio.gather(*history_fetches, return_exceptions=True),
+        )
+    complete = not any(isinstance(result, Exception) for result in [*semrush_dfs, *overviews, *histories])
+    semrush_dfs = without_failures(semrush_dfs, pd.DataFrame())
+    overviews = without_failures(overviews, {})
+    histories = without_failures(histories, None)
+
+    # Batches with no results come back as a bare error line, so leave them out of the combined frame
+    semrush_dfs = [df for df in semrush_dfs if not df.empty]
+    semrush_df = pd.concat(semrush_dfs, ignore_index=True) if semrush_dfs else pd.DataFrame()
+    ahrefs_overviews = {keyword: overview for batch in overviews for keyword, overview in batch.items()}
+    # Keywords whose history request failed are left out, so their months stay empty rather than zero
+    ahrefs_histories = {keyword: history for keyword, history in zip(keywords, histories) if history is not None}
+    return semrush_df, ahrefs_overviews, ahrefs_histories, complete
+
+def dedupe_keywords(keywords):
+    """Drop repeated keywords regardless of case and spacing, keeping the first spelling of each in input order."""
+    first_seen = {}
+    for keyword in keywords:
+        first_seen.setdefault(normalize_keyword(keyword), keyword)
+    return list(first_seen.values())
+
+@st.cache_data(ttl=PIPELINE_CACHE_TTL, show_spinner="Fetching...")
+def fetch_keyword_table(keywords, datasources, semrush_database, country, start_date, end_date):
+    """Fetch and assemble the output table for the given inputs, one row per keyword and datasource in input order.
+
+    Raises IncompleteTableError instead of returning when any request failed, so partial tables are never cached.
+    """
+    # Output months are the same for every keyword, so build them once per submit and
+    # only format them as month-year column labels here
+    if 'semrush' in datasources:
+        # SEMrush trends cover the 12 months ending at end_date
+        months = pd.period_range(end=end_date, periods=12, freq='M')
     else:
-        st.error(f"API request failed with status {response.status_code} and message: {response.text}")
-        return pd.DataFrame()
+        months = pd.period_range(start=start_date, end=end_date, freq='M')
+    date_columns = list(months.strftime('%b-%Y'))
+
+    # Fetch each distinct keyword once, then fan the results back out to every occurrence
+    unique_keywords = dedupe_keywords(keywords)
+    df_semrush, ahrefs_overviews, ahrefs_histories, complete = asyncio.run(fetch_all_keyword_data(unique_keywords, datasources, semrush_database, country, start_date, end_date))
+
+    # Derive the SEMrush monthly volumes for every keyword in one pass
+    frames = []
+    semrush_positions = {}
+    if not df_semrush.empty:
+        df_semrush.columns = df_semrush.columns.str.strip()
+        if 'Trends' in df_semrush.columns:
+            df_semrush['Trends'] = df_semrush['Trends'].str.strip()
+            monthly_df = vectorized_monthly_volumes(df_semrush, date_columns)
+            df_semrush[monthly_df.columns] = monthly_df
+            df_semrush['Datasource'] = 'SEMrush'
+            semrush_positions = {normalize_keyword(keyword): position for position, keyword in enumerate(df_semrush['Keyword'])}
+            frames.append(df_semrush)
+
+    # Ahrefs rows follow the SEMrush rows in the combined frame
+    ahrefs_offset = sum(len(frame) for frame in frames)
+    if 'ahrefs' in datasources:
+        frames.append(build_ahrefs_frame(unique_keywords, ahrefs_overviews, ahrefs_histories, months))
+        ahrefs_positions = {normalize_keyword(keyword): ahrefs_offset + position for position, keyword in enumerate(unique_keywords)}
+
+    # Pick output rows in input order, with each keyword's SEMrush row ahead of its Ahrefs row,
+    # and remember which input keyword each row belongs to
+    row_order = []
+    row_keywords = []
+    for keyword in keywords:
+        normalized = normalize_keyword(keyword)
+        if 'semrush' in datasources:
+            if normalized in semrush_positions:
+                row_order.append(semrush_positions[normalized])
+                row_keywords.append(keyword)
+            elif not df_semrush.empty and 'Trends' not in df_semrush.columns:
+                st.warning(f"Skipping keyword '{keyword}' as 'Trends' column is missing.")
+            else:
+                st.warning(f"No data found for keyword '{keyword}'.")
+        if 'ahrefs' in datasources:
+            row_order.append(ahrefs_positions[normalized])
+            row_keywords.append(keyword)
+
+    table = pd.DataFrame()
+    if row_order:
+        table = pd.concat(frames, ignore_index=True).take(row_order).reset_index(drop=True)
+        # Results come back under the API's or the first-seen spelling; label each row with its input spelling
+        table['Keyword'] = row_keywords
+    if not complete:
+        raise IncompleteTableError(table)
+    return table
+
+@st.cache_data
+def dataframe_to_csv(df):
+    """Serialize a DataFrame to CSV text."""
+    return df.to_csv(index=False)
+
+@st.cache_data
+def dataframe_to_csv_gzip(df):
+    """Serialize a DataFrame to gzip-compressed CSV bytes."""
+    return gzip.compress(dataframe_to_csv(df).encode('utf-8'), compresslevel=GZIP_COMPRESS_LEVEL)
+
+@st.cache_data
+def dataframe_to_parquet(df):
+    """Serialize a DataFrame to zstd-compressed Parquet bytes."""
+    # Arrow needs a single type per column, so any remaining mixed object columns are stored as strings
+    object_columns = df.select_dtypes(include='object').columns
+    buffer = BytesIO()
+    df.astype({col: 'string' for col in object_columns}).to_parquet(buffer, index=False, compression='zstd', compression_level=1)
+    return buffer.getvalue()
 
 # Streamlit UI
 st.title("Keyword Data Fetcher")
 
 with st.form(key='keyword_form'):
     keywords = st.text_area("Keywords (one per line):")
-    selected_country = st.selectbox("Country:", [name for _, name in country_list])
+    selected_country = st.selectbox("Country:", country_names)
     datasource_se = st.checkbox("SEMrush", value=True)
     datasource_ah = st.checkbox("Ahrefs", value=True)
     start_date = st.date_input("Start Date:")
     end_date = st.date_input("End Date:")
+    output_format = st.selectbox("Download Format:", ["CSV", "Parquet"])
     submit_button = st.form_submit_button(label='Fetch Data')
 
 if submit_button:
@@ -152,85 +421,40 @@ if submit_button:
     if datasource_ah:
         datasources.append('ahrefs')
     
-    selected_country_code = [code for code, name in country_list if name == selected_country][0]
-    semrush_selected_country_code = [code for code, name in country_list if name == selected_country][0]
+    selected_country_code = country_name_to_code[selected_country]
+    semrush_selected_country_code = selected_country_code
     if selected_country_code == "GB":
         semrush_selected_country_code = "UK"
 
     end_date = datetime.combine(end_date, datetime.min.time())
     start_date = datetime.combine(start_date, datetime.min.time()) if start_date else end_date - relativedelta(months=11)
 
-    dataframes = []
-
-    for keyword in keywords:
-        combined_df = pd.DataFrame()
-        
-        if 'semrush' in datasources:
-            df_semrush = fetch_semrush_data(keyword.strip(), database=semrush_selected_country_code, display_date=end_date.strftime("%Y%m15"))
-            if not df_semrush.empty:
-                df_semrush.columns = df_semrush.columns.str.strip()
-                if 'Trends' in df_semrush.columns:
-                    df_semrush['Trends'] = df_semrush['Trends'].str.strip()
-                    monthly_df = df_semrush.apply(lambda row: calculate_monthly_volumes(row, end_date), axis=1)
-                    df_semrush = pd.concat([df_semrush, monthly_df], axis=1)
-                    df_semrush['Datasource'] = 'SEMrush'
-                    dataframes.append(df_semrush)
-                else:
-                    st.warning(f"Skipping keyword '{keyword}' as 'Trends' column is missing.")
-            else:
-                st.warning(f"No data found for keyword '{keyword}'.")
+    # Identical inputs reuse the table from the last fetch instead of calling the APIs again;
+    # tables with failed requests are not cached, so resubmitting retries them
+    try:
+        final_df = fetch_keyword_table(tuple(keywords), tuple(datasources), semrush_selected_country_code, selected_country_code, start_date, end_date)
+    except IncompleteTableError as error:
+        final_df = error.table
 
-        if 'ahrefs' in datasources:
-            if 'semrush' in datasources:
-                df_ahrefs_history = fetch_ahrefs_history_data(keyword, selected_country_code, start_date, end_date, fetch_last_12_months=True)
-                ahrefs_overview_data = fetch_ahrefs_overview_data(keyword, selected_country_code)
-                date_columns = [datetime.strptime(col, '%b-%Y').strftime('%b-%Y') for col in df_semrush.columns if col not in ['Keyword', 'Search Volume', 'CPC', 'Competition', 'Number of Results', 'Trends', 'Datasource']]
-            else:
-                df_ahrefs_history = fetch_ahrefs_history_data(keyword, selected_country_code, start_date, end_date)
-                ahrefs_overview_data = fetch_ahrefs_overview_data(keyword, selected_country_code)
-                dates = [start_date + relativedelta(months=i) for i in range((end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1)]
-                date_columns = [date.strftime('%b-%Y') for date in dates]
-                combined_df = pd.DataFrame(columns=['Keyword', 'Search Volume', 'CPC', 'Global Volume', 'Parent Volume'] + date_columns)
-
-            if not df_ahrefs_history.empty:
-                row_ahrefs = {
-                    'Keyword': keyword,
-                    'Search Volume': ahrefs_overview_data.get('volume', ''),
-                    'CPC': ahrefs_overview_data.get('cpc', ''),
-                    'Global Volume': ahrefs_overview_data.get('global_volume', ''),
-                    'Parent Volume': ahrefs_overview_data.get('parent_volume', ''),
-                    'Datasource': 'Ahrefs'
-                }
-                for _, ahrefs_row in df_ahrefs_history.iterrows():
-                    if ahrefs_row['Month-Year'] in date_columns:
-                        row_ahrefs[ahrefs_row['Month-Year']] = ahrefs_row['Volume']
-                combined_df = pd.concat([combined_df, pd.DataFrame([row_ahrefs])], ignore_index=True)
-            else:
-                row_ahrefs = {
-                    'Keyword': keyword,
-                    'Search Volume': ahrefs_overview_data.get('volume', ''),
-                    'CPC': ahrefs_overview_data.get('cpc', ''),
-                    'Global Volume': ahrefs_overview_data.get('global_volume', ''),
-                    'Parent Volume': ahrefs_overview_data.get('parent_volume', ''),
-                    'Datasource': 'Ahrefs'
-                }
-                for date_col in date_columns:
-                    row_ahrefs[date_col] = 0  # Or some default value if no historical data available
-                combined_df = pd.concat([combined_df, pd.DataFrame([row_ahrefs])], ignore_index=True)
-            
-            dataframes.append(combined_df)
-
-    if dataframes:
-        final_df = pd.concat(dataframes, ignore_index=True)
-        st.session_state['data'] = final_df.to_csv(index=False)
-        st.success('Data fetched and CSV available to download')
+    if not final_df.empty:
+        # Only serialize the format the user asked for
+        if output_format == 'Parquet':
+            st.session_state['data'] = dataframe_to_parquet(final_df)
+            file_name, mime = 'keyword_data.parquet', 'application/octet-stream'
+        elif len(final_df) > GZIP_CSV_ROW_THRESHOLD:
+            st.session_state['data'] = dataframe_to_csv_gzip(final_df)
+            file_name, mime = 'keyword_data.csv.gz', 'application/gzip'
+        else:
+            st.session_state['data'] = dataframe_to_csv(final_df)
+            file_name, mime = 'keyword_data.csv', 'text/csv'
+        st.success(f'Data fetched and {output_format} available to download')
         st.dataframe(final_df)
-        csv = st.session_state.get('data')
+        data = st.session_state.get('data')
         st.download_button(
-            label="Download CSV",
-            data=csv,
-            file_name='keyword_data.csv',
-            mime='text/csv',
+            label=f"Download {output_format}",
+            data=data,
+            file_name=file_name,
+            mime=mime,
         )
     else:
         st.error('No data available for the provided criteria.')